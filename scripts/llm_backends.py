@@ -0,0 +1,447 @@
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import requests
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Iterator, List, Optional
+
+OLLAMA_URL = "http://localhost:11434/api/chat"
+OLLAMA_MODEL = "llama3.1"
+HF_BASE_URL = "https://router.huggingface.co/v1"
+HF_MODEL = "meta-llama/Llama-3.1-8B-Instruct"
+
+DEFAULT_HEDGE_DEADLINE = 2.0  # seconds to wait for a first token before hedging, until we have latency samples
+MIN_LATENCY_SAMPLES = 5  # samples needed before trusting the p95 estimate
+MAX_CONSECUTIVE_FAILURES = 3  # a backend is marked unhealthy after this many failures in a row
+RECOVERY_COOLDOWN = 30.0  # seconds after its last failure before an unhealthy backend is tried first again
+CONNECT_TIMEOUT = 5  # seconds to open the connection
+# Ollama sends nothing until prompt evaluation is done, which on CPU with a long history can take minutes,
+# so the wait for the first token gets its own, longer limit; READ_TIMEOUT applies between later tokens
+FIRST_TOKEN_TIMEOUT = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT", 600))
+READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", 60))
+OLLAMA_KEEP_ALIVE = "30m"  # keep the model (and its KV cache) loaded between turns instead of Ollama's 5m default
+OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", 8192))  # fixed context window; Ollama's default is too small for long sessions
+
+# --- HEALTH & LATENCY TRACKING ---
+class BackendStats:
+    def __init__(self, window: int = 50, recovery_cooldown: float = RECOVERY_COOLDOWN):
+        self.first_token_latencies = deque(maxlen=window)
+        self.recovery_cooldown = recovery_cooldown
+        self.consecutive_failures = 0
+        self.last_failure_at = None
+        self.total_requests = 0
+        self.total_failures = 0
+        self.lost_races = 0
+        self._lock = threading.Lock()
+
+    def record_first_token(self, seconds: float):
+        with self._lock:
+            self.first_token_latencies.append(seconds)
+
+    def record_success(self):
+        with self._lock:
+            self.total_requests += 1
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.total_requests += 1
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            self.last_failure_at = time.monotonic()
+
+    def record_lost(self, waited: float):
+        # Cancelled before producing a token: counts against health like a failure, and the time it had
+        # been waiting is kept as a (lower-bound) latency sample so the p95 does not only see winners
+        with self._lock:
+            self.first_token_latencies.append(waited)
+            self.total_requests += 1
+            self.lost_races += 1
+            self.consecutive_failures += 1
+            self.last_failure_at = time.monotonic()
+
+    @property
+    def healthy(self) -> bool:
+        # After the cooldown an unhealthy backend gets tried in its normal place again; one more
+        # failure restarts the cooldown, one success resets it fully
+        if self.consecutive_failures < MAX_CONSECUTIVE_FAILURES:
+            return True
+        return time.monotonic() - self.last_failure_at >= self.recovery_cooldown
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.first_token_latencies)
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+    def summary(self) -> dict:
+        p95 = self.p95()
+        return {
+            "healthy": self.healthy,
+            "requests": self.total_requests,
+            "failures": self.total_failures,
+            "lost_races": self.lost_races,
+            "p95_first_token_s": round(p95, 3) if p95 is not None else None,
+        }
+
+# --- BACKENDS ---
+class _Watchdog:
+    # Calls on_expire once the deadline passes; extend() moves the deadline (one thread per request)
+    def __init__(self, on_expire: Callable[[], None], timeout: float):
+        self.fired = False
+        self._on_expire = on_expire
+        self._deadline = time.monotonic() + timeout
+        self._stopped = False
+        self._cond = threading.Condition()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        with self._cond:
+            while not self._stopped:
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    self.fired = True
+                    break
+                self._cond.wait(remaining)
+        if self.fired:
+            self._on_expire()
+
+    def extend(self, timeout: float):
+        # Wakes the watcher, since the new deadline may be earlier than the one it is sleeping towards
+        with self._cond:
+            self._deadline = time.monotonic() + timeout
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+def _abort_response(response: requests.Response):
+    # Shut the socket down rather than only closing it: close() does not wake a thread blocked in recv()
+    # (it even waits for that read), shutdown() makes the read fail straight away and the disconnect
+    # stops generation server-side. fromfd() works on a duplicate descriptor of the same connection.
+    try:
+        sock = socket.fromfd(response.raw.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    except (OSError, ValueError, AttributeError):
+        return  # already closed
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+class LLMBackend(ABC):
+    """Common interface for chat backends: stream reply tokens for a list of chat messages."""
+
+    name = "backend"
+
+    def __init__(self):
+        self.stats = BackendStats()
+        self.last_metrics = None  # timing reported by the server for the last completed request, if it reports any
+        self.first_token_timeout = FIRST_TOKEN_TIMEOUT
+        self.read_timeout = READ_TIMEOUT
+
+    @abstractmethod
+    def stream_chat(self, messages: List[dict], on_connect: Optional[Callable[[Callable[[], None]], None]] = None) -> Iterator[str]:
+        """
+        Yields reply tokens. Once the request is open, on_connect (if given) is called with a function
+        that aborts it; that function must be safe to call from another thread while this one is blocked.
+        """
+
+    def chat(self, messages: List[dict]) -> str:
+        return "".join(self.stream_chat(messages))
+
+    def _post_stream(self, url: str, payload: dict, on_connect, headers: Optional[dict] = None) -> requests.Response:
+        # No requests read timeout: it would apply to every read, so _iter_lines enforces the two limits instead
+        response = requests.post(url, json=payload, headers=headers, stream=True, timeout=(CONNECT_TIMEOUT, None))
+        if on_connect:
+            on_connect(lambda: _abort_response(response))
+        return response
+
+    def _iter_lines(self, response: requests.Response) -> Iterator[bytes]:
+        # Up to first_token_timeout for the first non-empty line, then read_timeout between lines
+        watchdog = _Watchdog(lambda: _abort_response(response), self.first_token_timeout)
+        try:
+            for line in response.iter_lines():
+                if watchdog.fired:
+                    break
+                if line:
+                    watchdog.extend(self.read_timeout)
+                yield line
+        except Exception:
+            if not watchdog.fired:
+                raise
+        finally:
+            watchdog.stop()
+        if watchdog.fired:
+            # The abort usually ends the read as a clean EOF, which must not pass for a complete reply
+            raise TimeoutError(f"{self.name}: no data from the server within the time limit")
+
+class OllamaBackend(LLMBackend):
+    def __init__(self, url: str = OLLAMA_URL, model: str = OLLAMA_MODEL, name: str = "ollama",
+                 keep_alive: str = OLLAMA_KEEP_ALIVE, options: Optional[dict] = None):
+        super().__init__()
+        self.url = url
+        self.model = model
+        self.name = name
+        self.keep_alive = keep_alive
+        # Must stay identical across requests: changing e.g. num_ctx reloads the model and drops the KV cache
+        self.options = options or {}
+
+    def _payload(self, messages: List[dict]) -> dict:
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": True,  # Important: Streaming output
+            "keep_alive": self.keep_alive,
+        }
+        if self.options:
+            payload["options"] = self.options
+        return payload
+
+    def preload(self):
+        # A request with no messages just loads the model, so the first real turn does not pay the load time.
+        # Same options/keep_alive as the chat requests, or the first turn reloads it with a different num_ctx.
+        payload = self._payload([])
+        payload["stream"] = False
+        response = requests.post(self.url, json=payload, timeout=(CONNECT_TIMEOUT, self.first_token_timeout))
+        response.raise_for_status()
+
+    def stream_chat(self, messages: List[dict], on_connect=None) -> Iterator[str]:
+        self.last_metrics = None  # so a stream that ends without a "done" chunk does not report the previous turn
+        response = self._post_stream(self.url, self._payload(messages), on_connect)
+        try:
+            response.raise_for_status()
+            for line in self._iter_lines(response):
+                if line:
+                    try:
+                        data = json.loads(line.decode("utf-8"))
+                    except Exception as e:
+                        print(f"⚠️ Failed to parse line: {line}\nError: {e}")
+                        continue
+                    if "error" in data:
+                        raise RuntimeError(f"{self.name}: {data['error']}")
+                    if data.get("done"):
+                        # prompt_eval_count only counts tokens not served from the KV cache
+                        self.last_metrics = {
+                            "prompt_eval_count": data.get("prompt_eval_count", 0),
+                            "prompt_eval_ms": data.get("prompt_eval_duration", 0) / 1e6,
+                            "eval_count": data.get("eval_count", 0),
+                            "load_ms": data.get("load_duration", 0) / 1e6,
+                        }
+                    delta = data.get("message", {}).get("content", "")
+                    if delta:
+                        yield delta
+        finally:
+            response.close()
+
+def _cached_hf_token() -> Optional[str]:
+    # Token saved by `huggingface-cli login`, if huggingface_hub is installed
+    try:
+        from huggingface_hub import get_token
+    except ImportError:
+        return None
+    return get_token()
+
+def hf_token() -> Optional[str]:
+    return os.environ.get("HF_TOKEN") or _cached_hf_token()
+
+class HuggingFaceBackend(LLMBackend):
+    # Talks to the OpenAI-compatible chat endpoint that InferenceClient uses, directly over requests,
+    # so a stalled stream can be aborted from another thread like the Ollama one
+    def __init__(self, model: str = HF_MODEL, base_url: Optional[str] = None, name: str = "huggingface",
+                 token: Optional[str] = None):
+        super().__init__()
+        self.url = (base_url or HF_BASE_URL).rstrip("/") + "/chat/completions"
+        self.model = model
+        self.name = name
+        self.token = token or hf_token()
+
+    def stream_chat(self, messages: List[dict], on_connect=None) -> Iterator[str]:
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else None
+        payload = {"model": self.model, "messages": messages, "stream": True}
+        response = self._post_stream(self.url, payload, on_connect, headers)
+        try:
+            response.raise_for_status()
+            # Server-sent events: "data: {json}" lines, terminated by "data: [DONE]"
+            for line in self._iter_lines(response):
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data.decode("utf-8"))
+                if "error" in chunk:
+                    raise RuntimeError(f"{self.name}: {chunk['error']}")
+                choices = chunk.get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+        finally:
+            response.close()
+
+# --- ROUTING, FALLBACK & HEDGING ---
+class _Attempt:
+    # One in-flight request to a backend, running on its own thread and reporting into a shared queue
+    def __init__(self, backend: LLMBackend, messages: List[dict], events: queue.Queue):
+        self.backend = backend
+        self.cancelled = threading.Event()
+        self.started_at = time.monotonic()
+        self.got_first_token = False
+        self.finished = False
+        self._abort = None
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, args=(messages, events), daemon=True)
+        self.thread.start()
+
+    def _on_connect(self, abort: Callable[[], None]):
+        with self._lock:
+            self._abort = abort
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            abort()  # cancelled while still connecting
+
+    def _run(self, messages, events):
+        try:
+            for token in self.backend.stream_chat(messages, on_connect=self._on_connect):
+                with self._lock:
+                    if self.cancelled.is_set():
+                        return
+                    first = not self.got_first_token
+                    self.got_first_token = True
+                if first:
+                    self.backend.stats.record_first_token(time.monotonic() - self.started_at)
+                events.put((self, "token", token))
+        except Exception as e:
+            with self._lock:
+                if self.cancelled.is_set():
+                    return  # the abort itself makes the read fail; cancel() already did the bookkeeping
+                self.finished = True
+            self.backend.stats.record_failure()
+            events.put((self, "error", e))
+            return
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.finished = True
+        self.backend.stats.record_success()
+        events.put((self, "done", None))
+
+    def cancel(self, lost_race: bool = False):
+        # lost_race: another attempt won. Otherwise (e.g. the caller gave up) the stats are left alone.
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            abort = self._abort
+            lost = lost_race and not self.got_first_token and not self.finished
+        if lost:
+            self.backend.stats.record_lost(time.monotonic() - self.started_at)
+        if abort:
+            abort()
+
+class BackendRouter:
+    """
+    Sends each request to the preferred healthy backend and falls back to the next one if it fails
+    before producing any output. With hedge=True, a second request is also fired at the next backend
+    when the first has not produced a token within its p95 first-token latency; whichever streams
+    first wins and the other is cancelled.
+    """
+
+    def __init__(self, backends: List[LLMBackend], hedge: bool = False, default_deadline: float = DEFAULT_HEDGE_DEADLINE):
+        if not backends:
+            raise ValueError("BackendRouter needs at least one backend")
+        self.backends = backends
+        self.hedge = hedge
+        self.default_deadline = default_deadline
+        self.last_backend = None  # backend that served the most recent reply
+
+    def _ordered_backends(self) -> List[LLMBackend]:
+        # Keep the configured preference order, but try unhealthy backends only as a last resort
+        return [b for b in self.backends if b.stats.healthy] + [b for b in self.backends if not b.stats.healthy]
+
+    def _hedge_deadline(self, backend: LLMBackend) -> float:
+        p95 = backend.stats.p95()
+        return p95 if p95 is not None else self.default_deadline
+
+    def stream_chat(self, messages: List[dict]) -> Iterator[str]:
+        pending = self._ordered_backends()
+        events = queue.Queue()
+        attempts = [_Attempt(pending.pop(0), messages, events)]
+        hedge_at = attempts[0].started_at + self._hedge_deadline(attempts[0].backend)
+        winner = None
+        last_error = None
+
+        try:
+            while True:
+                timeout = None
+                if winner is None and self.hedge and pending:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    attempt, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    # First backend is slower than usual: hedge with the next one
+                    attempts.append(_Attempt(pending.pop(0), messages, events))
+                    hedge_at = attempts[-1].started_at + self._hedge_deadline(attempts[-1].backend)
+                    continue
+
+                if winner is not None and attempt is not winner:
+                    continue  # leftovers from a cancelled loser
+
+                if kind == "token":
+                    if winner is None:
+                        winner = attempt
+                        self.last_backend = attempt.backend
+                        for other in attempts:
+                            if other is not winner:
+                                other.cancel(lost_race=True)
+                    yield payload
+                elif kind == "done":
+                    if winner is None:
+                        winner = attempt  # finished without output: an empty reply is still a reply
+                        self.last_backend = attempt.backend
+                        for other in attempts:
+                            if other is not winner:
+                                other.cancel(lost_race=True)
+                    return
+                elif kind == "error":
+                    if winner is not None:
+                        raise payload  # failed mid-stream; part of the reply was already sent
+                    print(f"⚠️ {attempt.backend.name} failed: {payload}")
+                    last_error = payload
+                    attempts.remove(attempt)
+                    if pending:
+                        attempts.append(_Attempt(pending.pop(0), messages, events))
+                        hedge_at = attempts[-1].started_at + self._hedge_deadline(attempts[-1].backend)
+                    elif not attempts:
+                        raise RuntimeError("All LLM backends failed") from last_error
+        finally:
+            # Also runs when the caller stops reading or is interrupted; nobody won then, so no lost races
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+            if winner is not None:
+                winner.cancel()
+
+    def chat(self, messages: List[dict]) -> str:
+        return "".join(self.stream_chat(messages))
+
+    def health(self) -> dict:
+        return {b.name: b.stats.summary() for b in self.backends}
+
+def backends_from_env() -> BackendRouter:
+    # Ollama first; Hugging Face is added as the alternate when a token (HF_TOKEN or a
+    # `huggingface-cli login`) or a custom endpoint is configured
+    backends = [OllamaBackend(os.environ.get("OLLAMA_URL", OLLAMA_URL), os.environ.get("OLLAMA_MODEL", OLLAMA_MODEL),
+                              keep_alive=os.environ.get("OLLAMA_KEEP_ALIVE", OLLAMA_KEEP_ALIVE),
+                              options={"num_ctx": OLLAMA_NUM_CTX})]
+    if os.environ.get("HF_BASE_URL") or hf_token():
+        backends.append(HuggingFaceBackend(os.environ.get("HF_MODEL", HF_MODEL), os.environ.get("HF_BASE_URL")))
+    return BackendRouter(backends, hedge=os.environ.get("LLM_HEDGE", "0") == "1")
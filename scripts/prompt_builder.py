@@ -0,0 +1,62 @@
+from typing import List, Optional
+
+SYSTEM_PROMPT = (
+    "You are an exam-focused tutor helping a student revise for their syllabus. "
+    "Each question comes with context retrieved from the official syllabus and from study notes. "
+    "Prefer the syllabus context when the two disagree, stay within the syllabus scope, "
+    "and give clear, step-by-step explanations in the style expected in the exam."
+)
+CHARS_PER_TOKEN = 4  # rough average for English text with Llama-style tokenizers
+
+def estimate_tokens(messages: List[dict]) -> int:
+    return sum(len(m["content"]) for m in messages) // CHARS_PER_TOKEN
+
+# --- PROMPT LAYOUT ---
+class PromptBuilder:
+    """
+    Lays out chat messages so consecutive turns share the longest possible prompt prefix, letting the
+    model reuse its KV cache instead of re-reading the whole conversation:
+
+        [fixed system prompt] + [append-only history] + [question + this turn's retrieved context]
+
+    Retrieved context only ever appears in the last message and is not stored in the history.
+    """
+
+    def __init__(self, system_prompt: str = SYSTEM_PROMPT, history_token_budget: Optional[int] = None):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.history: List[dict] = []
+        # Keep well below the model's context window, or the server truncates the oldest messages itself
+        # and the cut point (and so the prefix) moves every turn
+        self.history_token_budget = history_token_budget
+
+    def build(self, question: str, context: str) -> List[dict]:
+        # Same question text as stored in history, so the next turn's prefix still matches up to here
+        return [self.system_message] + self.history + [
+            {"role": "user", "content": f"{question}\n\nContext:\n{context}"}
+        ]
+
+    def record_turn(self, question: str, reply: str):
+        # History is append-only between trims: earlier messages are never rewritten, so they stay a cacheable prefix
+        self.history.append({"role": "user", "content": question})
+        self.history.append({"role": "assistant", "content": reply})
+        if self.history_token_budget and estimate_tokens(self.history) > self.history_token_budget:
+            self._trim_history()
+
+    def _trim_history(self):
+        # Drop the oldest half in one go rather than a turn at a time: the cache is invalidated once per
+        # trim and the new prefix then stays stable for many turns
+        turns = len(self.history) // 2
+        self.history = self.history[2 * (turns // 2 + turns % 2):]
+
+def format_turn_metrics(messages: List[dict], metrics: Optional[dict]) -> str:
+    if not metrics:
+        return "📊 no prompt-eval timing reported by this backend"
+    # prompt_eval_count only covers tokens the server actually evaluated; the rest came from its KV cache.
+    # The prompt size is estimated, so the cache share is approximate.
+    prompt_tokens = max(estimate_tokens(messages), metrics["prompt_eval_count"], 1)
+    reused = 1 - metrics["prompt_eval_count"] / prompt_tokens
+    line = (f"📊 prompt eval {metrics['prompt_eval_count']} of ~{prompt_tokens} tokens in "
+            f"{metrics['prompt_eval_ms']:.0f} ms (~{reused:.0%} from cache)")
+    if metrics["load_ms"] > 1000:
+        line += f", model load {metrics['load_ms']:.0f} ms"
+    return line
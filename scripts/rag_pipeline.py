@@ -1,8 +1,6 @@
 import os
 import re
-import requests
-import json
-from typing import List
+from typing import Iterable, Iterator, List
 from langchain_community.vectorstores import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -10,6 +8,8 @@ from langchain.schema import Document
 from langchain.chains import ConversationalRetrievalChain
 from langchain.memory import ConversationBufferMemory
 from langchain_community.document_loaders import TextLoader
+from llm_backends import OLLAMA_NUM_CTX, OllamaBackend, backends_from_env
+from prompt_builder import PromptBuilder, format_turn_metrics
 
 CATEGORY_LIST = {
     "PSLE": "PSLE",
@@ -54,70 +54,91 @@ SYLLABUS_FILE = "./olevelphysics/O Level Physics Syllabus_nougat.mmd"  # folder
 NOTES_FOLDER = "./olevelphysics/notes"
 CHROMA_DB_DIR = "./chroma_db/"
 EMBEDDING_MODEL = "all-MiniLM-L6-v2"
-OLLAMA_URL = "http://localhost:11434/api/chat"
+EMBEDDING_DIM = 384  # output size of EMBEDDING_MODEL
+INDEX_COMPLETE_MARKER = ".index_complete"  # written into CHROMA_DB_DIR once a build has finished
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", 64))  # max chunks embedded + inserted per call
+# Ceiling on the estimated memory of one batch: its chunk text plus the embedding vectors computed for it
+# (see estimate_chunk_bytes). It does not bound the embedding model itself or the process as a whole.
+UPSERT_MAX_BATCH_BYTES = int(os.environ.get("UPSERT_MAX_BATCH_BYTES", 512 * 1024))
 
 # --- DOCUMENT LOADING ---
-def load_documents(syllabus_path: str, notes_folder: str) -> List[Document]:
-    all_docs = []
+def load_documents(syllabus_path: str, notes_folder: str) -> Iterator[Document]:
+    # Yields one document at a time so the whole corpus is never held in memory
 
     # Load syllabus
-    syllabus_loader = TextLoader(syllabus_path)
-    syllabus_docs = syllabus_loader.load()
-    for doc in syllabus_docs:
+    for doc in TextLoader(syllabus_path).lazy_load():
         doc.metadata["source"] = "SYLLABUS"
-    all_docs.extend(syllabus_docs)
+        yield doc
 
     # Load handwritten notes
-    for filename in os.listdir(notes_folder):
+    for filename in sorted(os.listdir(notes_folder)):
         if filename.endswith(".mmd"):
             path = os.path.join(notes_folder, filename)
-            loader = TextLoader(path)
-            docs = loader.load()
-            for doc in docs:
+            for doc in TextLoader(path).lazy_load():
                 doc.metadata["source"] = f"NOTES: {filename}"
-            all_docs.extend(docs)
-
-    return all_docs
+                yield doc
 
 # --- CHUNKING ---
-def chunk_documents(documents):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    return splitter.split_documents(documents)
+def chunk_documents(documents: Iterable[Document]) -> Iterator[Document]:
+    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100, add_start_index=True)
+    for doc in documents:
+        yield from splitter.split_documents([doc])
+
+def estimate_chunk_bytes(doc: Document) -> int:
+    # Text is held twice (Document + the copy handed to the embedder); each vector comes back
+    # as a Python list of floats, roughly 32 bytes per dimension (8 for the pointer + 24 for the float)
+    return 2 * len(doc.page_content.encode("utf-8")) + EMBEDDING_DIM * 32
+
+def batch_documents(docs: Iterable[Document], batch_size: int = UPSERT_BATCH_SIZE, max_bytes: int = UPSERT_MAX_BATCH_BYTES) -> Iterator[List[Document]]:
+    # Flush when either the chunk count or the estimated batch memory hits its limit
+    batch, batch_bytes = [], 0
+    for doc in docs:
+        doc_bytes = estimate_chunk_bytes(doc)
+        if batch and (len(batch) >= batch_size or batch_bytes + doc_bytes > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(doc)
+        batch_bytes += doc_bytes
+    if batch:
+        yield batch
 
 # --- EMBEDDING & STORAGE ---
-def embed_and_store(docs, persist_dir):
-    embedder = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
-    vectordb = Chroma.from_documents(docs, embedding=embedder, persist_directory=persist_dir)
+def embed_and_store(docs: Iterable[Document], persist_dir: str, batch_size: int = UPSERT_BATCH_SIZE, max_bytes: int = UPSERT_MAX_BATCH_BYTES, embedder=None):
+    embedder = embedder or HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    vectordb = Chroma(persist_directory=persist_dir, embedding_function=embedder)
+
+    # A rebuild over an interrupted or outdated index must not leave it looking finished midway
+    marker = os.path.join(persist_dir, INDEX_COMPLETE_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    # Embed and upsert batch by batch instead of Chroma.from_documents on the whole corpus
+    seen_ids = set()
+    for batch in batch_documents(docs, batch_size, max_bytes):
+        # Stable ids make a rebuild overwrite existing chunks (Chroma upserts by id) instead of duplicating them
+        ids = [f"{doc.metadata['source']}:{doc.metadata['start_index']}" for doc in batch]
+        vectordb.add_documents(batch, ids=ids)
+        seen_ids.update(ids)
+        print(f"📦 Stored {len(seen_ids)} chunks...")
+
+    # Drop chunks from files that were removed or shrunk since the last build
+    stale_ids = [i for i in vectordb.get(include=[])["ids"] if i not in seen_ids]
+    if stale_ids:
+        vectordb.delete(ids=stale_ids)
+        print(f"🧹 Removed {len(stale_ids)} stale chunks")
+
     vectordb.persist()
+    os.makedirs(persist_dir, exist_ok=True)
+    with open(marker, "w") as f:
+        f.write(f"{len(seen_ids)}\n")
     return vectordb
 
-# --- OLLAMA CHAT INTERFACE ---
-def query_ollama(prompt: str, history: List[dict]) -> str:
-    payload = {
-        "model": "llama3.1",
-        "messages": history + [{"role": "user", "content": prompt}],
-        "stream": True  # Important: Streaming output
-    }
-    response = requests.post(OLLAMA_URL, json=payload, stream=True)
-    response.raise_for_status()
-
-    # Stream the chunks and combine them
-    full_reply = ""
-    for line in response.iter_lines():
-        if line:
-            try:
-                data = json.loads(line.decode("utf-8"))
-                delta = data.get("message", {}).get("content", "")
-                full_reply += delta
-            except Exception as e:
-                print(f"⚠️ Failed to parse line: {line}\nError: {e}")
-    return full_reply
-
 # --- MAIN ---
 if __name__ == "__main__":
     print("🔍 Loading or building vector DB...")
 
-    if os.path.exists(CHROMA_DB_DIR):
+    # Without the marker the last build did not finish, so (re)build; upserts reuse whatever was stored
+    if os.path.exists(os.path.join(CHROMA_DB_DIR, INDEX_COMPLETE_MARKER)):
         vectordb = Chroma(persist_directory=CHROMA_DB_DIR, embedding_function=HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL))
     else:
         docs = load_documents(SYLLABUS_FILE, NOTES_FOLDER)
@@ -127,7 +148,18 @@ if __name__ == "__main__":
     retriever = vectordb.as_retriever()
     memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
 
-    chat_history = []
+    # Ollama, plus Hugging Face as fallback/hedge target when HF_TOKEN or HF_BASE_URL is set (LLM_HEDGE=1 to hedge)
+    llm = backends_from_env()
+    for backend in llm.backends:
+        if isinstance(backend, OllamaBackend):
+            try:
+                backend.preload()
+            except Exception as e:
+                print(f"⚠️ Could not preload {backend.name}: {e}")
+
+    # Stable system prompt + append-only history first, this turn's retrieved context last;
+    # half the context window is left for the system prompt, retrieved context and the reply
+    prompt_builder = PromptBuilder(history_token_budget=OLLAMA_NUM_CTX // 2)
     print("🤖 Tutor Bot ready! Type 'exit' to quit.")
 
     while True:
@@ -145,12 +177,12 @@ if __name__ == "__main__":
         context = syllabus_context + "\n\n" + notes_context
 
         # Compose prompt
-        full_prompt = f"Context:\n{context}\n\nQuestion: {user_input}"
+        messages = prompt_builder.build(user_input, context)
 
         try:
-            reply = query_ollama(full_prompt, chat_history)
+            reply = llm.chat(messages)
             print(f"AI: {reply}\n")
-            chat_history.append({"role": "user", "content": user_input})
-            chat_history.append({"role": "assistant", "content": reply})
+            print(format_turn_metrics(messages, llm.last_backend.last_metrics))
+            prompt_builder.record_turn(user_input, reply)
         except Exception as e:
             print(f"⚠️ Error: {e}")
\ No newline at end of file
@@ -0,0 +1,271 @@
+import json
+import time
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import llm_backends
+from llm_backends import BackendRouter, BackendStats, HuggingFaceBackend, OllamaBackend, MAX_CONSECUTIVE_FAILURES, backends_from_env
+
+# --- LOCAL STUB SERVERS ---
+class StubServer:
+    """
+    Local stand-in for an LLM server. It can stall before the first token (sending only keep-alive
+    newlines), pause between tokens, fail with an HTTP error, or report an error after some tokens.
+    """
+
+    def __init__(self, tokens=("Hello", " world"), stall=0.0, gap=0.0, status=200, fail_after=None, sse=False):
+        self.tokens = tokens
+        self.stall = stall
+        self.gap = gap
+        self.status = status
+        self.fail_after = fail_after
+        self.sse = sse
+        self.requests = []
+        self.disconnected = threading.Event()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _line(self, data):
+        if self.sse:
+            return f"data: {json.dumps(data)}\n\n".encode()
+        return (json.dumps(data) + "\n").encode()
+
+    def _token(self, token):
+        if self.sse:
+            return self._line({"choices": [{"delta": {"content": token}}]})
+        return self._line({"message": {"role": "assistant", "content": token}, "done": False})
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Chunked HTTP/1.1 like Ollama, so every line reaches the client as soon as it is written
+            protocol_version = "HTTP/1.1"
+
+            def send(self, data):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def do_POST(self):
+                stub.requests.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+                if stub.status != 200:
+                    self.send_error(stub.status)
+                    return
+                self.send_response(200)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    deadline = time.monotonic() + stub.stall
+                    while time.monotonic() < deadline:
+                        self.send(b"\n")
+                        time.sleep(0.05)
+                    for i, token in enumerate(stub.tokens):
+                        if i:
+                            time.sleep(stub.gap)
+                        if stub.fail_after == i:
+                            self.send(stub._line({"error": "model crashed"}))
+                            break
+                        self.send(stub._token(token))
+                    else:
+                        if stub.sse:
+                            self.send(b"data: [DONE]\n\n")
+                        else:
+                            self.send(stub._line({"done": True, "prompt_eval_count": 12, "prompt_eval_duration": 3000000}))
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    stub.disconnected.set()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+@pytest.fixture
+def stubs():
+    servers = []
+
+    def make(**kwargs):
+        server = StubServer(**kwargs)
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.close()
+
+def ollama(stub, name):
+    return OllamaBackend(stub.url + "/api/chat", name=name)
+
+MESSAGES = [{"role": "user", "content": "What is a force?"}]
+
+# --- TESTS ---
+def test_streams_tokens_and_records_metrics(stubs):
+    backend = ollama(stubs(), "ollama")
+    assert list(backend.stream_chat(MESSAGES)) == ["Hello", " world"]
+    assert backend.last_metrics["prompt_eval_count"] == 12
+
+def test_metrics_are_reset_when_stream_ends_without_done(stubs):
+    backend = ollama(stubs(), "ollama")
+    backend.chat(MESSAGES)
+    assert backend.last_metrics is not None
+
+    backend.url = ollama(stubs(tokens=("a", "b"), fail_after=1), "flaky").url
+    with pytest.raises(RuntimeError):
+        backend.chat(MESSAGES)
+    assert backend.last_metrics is None
+
+def test_preload_uses_the_same_options_as_chat(stubs):
+    stub = stubs()
+    backend = OllamaBackend(stub.url + "/api/chat", keep_alive="45m", options={"num_ctx": 8192})
+    backend.preload()
+    backend.chat(MESSAGES)
+
+    preload, chat = stub.requests
+    assert preload["messages"] == []
+    assert preload["options"] == chat["options"] == {"num_ctx": 8192}
+    assert preload["keep_alive"] == chat["keep_alive"] == "45m"
+
+def test_huggingface_backend_parses_sse(stubs):
+    stub = stubs(sse=True)
+    backend = HuggingFaceBackend(base_url=stub.url + "/v1", token="test-token")
+    assert backend.chat(MESSAGES) == "Hello world"
+    assert stub.requests[0]["stream"] is True
+
+def test_first_token_timeout(stubs):
+    backend = ollama(stubs(stall=5), "stalled")
+    backend.first_token_timeout = 0.3
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        backend.chat(MESSAGES)
+    assert time.monotonic() - started < 2
+
+def test_slow_first_token_is_not_cut_off_by_read_timeout(stubs):
+    backend = ollama(stubs(stall=0.6), "slow_prompt_eval")
+    backend.first_token_timeout = 5
+    backend.read_timeout = 0.2
+
+    assert backend.chat(MESSAGES) == "Hello world"
+
+def test_read_timeout_between_tokens(stubs):
+    backend = ollama(stubs(gap=5), "stuck")
+    backend.read_timeout = 0.3
+
+    received = []
+    with pytest.raises(TimeoutError):
+        for token in backend.stream_chat(MESSAGES):
+            received.append(token)
+    assert received == ["Hello"]
+
+def test_hedge_fires_after_deadline(stubs):
+    slow, fast = stubs(stall=10), stubs(tokens=("fast",))
+    router = BackendRouter([ollama(slow, "slow"), ollama(fast, "fast")], hedge=True, default_deadline=0.3)
+
+    started = time.monotonic()
+    assert router.chat(MESSAGES) == "fast"
+    assert 0.3 <= time.monotonic() - started < 2
+    assert router.last_backend.name == "fast"
+
+def test_hedge_loser_connection_is_closed(stubs):
+    slow, fast = stubs(stall=10), stubs(tokens=("fast",))
+    router = BackendRouter([ollama(slow, "slow"), ollama(fast, "fast")], hedge=True, default_deadline=0.3)
+
+    router.chat(MESSAGES)
+    assert slow.disconnected.wait(2)
+    health = router.health()["slow"]
+    assert health["lost_races"] == 1
+    assert router.backends[0].stats.consecutive_failures == 1
+    assert len(router.backends[0].stats.first_token_latencies) == 1
+
+def test_interrupted_caller_does_not_count_as_lost_race(stubs, monkeypatch):
+    slow = stubs(stall=10)
+    router = BackendRouter([ollama(slow, "slow")])
+
+    class InterruptedQueue(queue.Queue):
+        def get(self, *args, **kwargs):
+            time.sleep(0.2)
+            raise KeyboardInterrupt  # e.g. Ctrl+C while waiting for the first token
+
+    monkeypatch.setattr(llm_backends.queue, "Queue", InterruptedQueue)
+    with pytest.raises(KeyboardInterrupt):
+        router.chat(MESSAGES)
+
+    assert slow.disconnected.wait(2)
+    stats = router.backends[0].stats
+    assert (stats.lost_races, stats.consecutive_failures, len(stats.first_token_latencies)) == (0, 0, 0)
+
+def test_no_hedge_without_opt_in(stubs):
+    slow, fast = stubs(stall=0.5, tokens=("slow",)), stubs(tokens=("fast",))
+    router = BackendRouter([ollama(slow, "slow"), ollama(fast, "fast")], default_deadline=0.1)
+
+    assert router.chat(MESSAGES) == "slow"
+    assert fast.requests == []
+
+def test_fallback_on_error_before_first_token(stubs):
+    broken, backup = stubs(status=500), stubs(tokens=("backup",))
+    router = BackendRouter([ollama(broken, "broken"), ollama(backup, "backup")])
+
+    assert router.chat(MESSAGES) == "backup"
+    assert router.health()["broken"]["failures"] == 1
+
+def test_mid_stream_error_raises(stubs):
+    flaky, backup = stubs(tokens=("a", "b", "c"), fail_after=1), stubs()
+    router = BackendRouter([ollama(flaky, "flaky"), ollama(backup, "backup")])
+
+    received = []
+    with pytest.raises(RuntimeError, match="model crashed"):
+        for token in router.stream_chat(MESSAGES):
+            received.append(token)
+    assert received == ["a"]
+    assert backup.requests == []  # part of the reply was already shown, so no silent restart elsewhere
+
+def test_all_backends_failed(stubs):
+    router = BackendRouter([ollama(stubs(status=500), "a"), ollama(stubs(status=503), "b")])
+
+    with pytest.raises(RuntimeError, match="All LLM backends failed"):
+        router.chat(MESSAGES)
+
+def test_unhealthy_backend_is_tried_last_then_recovers(stubs):
+    first, second = ollama(stubs(tokens=("first",)), "first"), ollama(stubs(tokens=("second",)), "second")
+    for _ in range(MAX_CONSECUTIVE_FAILURES):
+        first.stats.record_failure()
+    router = BackendRouter([first, second])
+
+    assert router.chat(MESSAGES) == "second"
+
+    first.stats.recovery_cooldown = 0
+    assert router.chat(MESSAGES) == "first"
+    assert first.stats.consecutive_failures == 0
+
+def test_p95_needs_enough_samples():
+    stats = BackendStats()
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        stats.record_first_token(seconds)
+    assert stats.p95() is None
+    stats.record_first_token(5.0)
+    assert stats.p95() == 5.0
+
+def test_cli_login_token_enables_huggingface_backend(monkeypatch):
+    monkeypatch.delenv("HF_TOKEN", raising=False)
+    monkeypatch.delenv("HF_BASE_URL", raising=False)
+
+    monkeypatch.setattr(llm_backends, "_cached_hf_token", lambda: None)
+    assert [b.name for b in backends_from_env().backends] == ["ollama"]
+
+    monkeypatch.setattr(llm_backends, "_cached_hf_token", lambda: "cli-token")
+    router = backends_from_env()
+    assert [b.name for b in router.backends] == ["ollama", "huggingface"]
+    assert router.backends[1].token == "cli-token"
@@ -0,0 +1,45 @@
+from prompt_builder import PromptBuilder, SYSTEM_PROMPT, estimate_tokens, format_turn_metrics
+
+def test_context_goes_last_and_is_not_kept_in_history():
+    builder = PromptBuilder()
+    messages = builder.build("What is a force?", "syllabus text")
+
+    assert messages[0] == {"role": "system", "content": SYSTEM_PROMPT}
+    assert messages[-1]["content"] == "What is a force?\n\nContext:\nsyllabus text"
+
+    builder.record_turn("What is a force?", "A push or a pull.")
+    assert builder.history == [
+        {"role": "user", "content": "What is a force?"},
+        {"role": "assistant", "content": "A push or a pull."},
+    ]
+
+def test_next_prompt_extends_previous_history():
+    builder = PromptBuilder()
+    first = builder.build("q1", "ctx1")
+    builder.record_turn("q1", "a1")
+    second = builder.build("q2", "ctx2")
+
+    assert second[:len(first) - 1] == first[:-1]
+    assert first[-1]["content"].startswith(second[len(first) - 1]["content"])
+
+def test_history_is_trimmed_by_half_in_whole_turns():
+    builder = PromptBuilder(history_token_budget=100)
+    for i in range(4):
+        builder.record_turn(f"question {i}", "x" * 80)  # ~22 tokens per turn
+    assert len(builder.history) == 8
+
+    builder.record_turn("question 4", "x" * 80)
+    assert [m["content"] for m in builder.history if m["role"] == "user"] == ["question 3", "question 4"]
+
+    # The trimmed prefix then stays unchanged until the budget is hit again
+    kept = list(builder.history)
+    builder.record_turn("question 5", "x" * 80)
+    assert builder.history[:len(kept)] == kept
+
+def test_turn_metrics_use_server_prompt_eval_count():
+    messages = [{"role": "user", "content": "x" * 400}]  # ~100 tokens
+    metrics = {"prompt_eval_count": 25, "prompt_eval_ms": 40.0, "eval_count": 10, "load_ms": 0.0}
+
+    assert estimate_tokens(messages) == 100
+    assert format_turn_metrics(messages, metrics) == "📊 prompt eval 25 of ~100 tokens in 40 ms (~75% from cache)"
+    assert "no prompt-eval timing" in format_turn_metrics(messages, None)
@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("langchain_community")
+pytest.importorskip("langchain_huggingface")
+
+from langchain.schema import Document
+
+from rag_pipeline import batch_documents, chunk_documents, estimate_chunk_bytes, load_documents
+
+def doc(text, source="SYLLABUS"):
+    return Document(page_content=text, metadata={"source": source})
+
+# --- BATCHING ---
+def test_batches_flush_on_batch_size():
+    docs = [doc(f"chunk {i}") for i in range(5)]
+    batches = list(batch_documents(docs, batch_size=2, max_bytes=10 ** 9))
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert [d for b in batches for d in b] == docs
+
+def test_batches_flush_on_max_bytes():
+    docs = [doc("x" * 100) for _ in range(5)]
+    per_chunk = estimate_chunk_bytes(docs[0])
+    batches = list(batch_documents(docs, batch_size=100, max_bytes=2 * per_chunk))
+    assert [len(b) for b in batches] == [2, 2, 1]
+
+def test_chunk_larger_than_max_bytes_gets_its_own_batch():
+    small, big = doc("x" * 10), doc("x" * 10_000)
+    max_bytes = estimate_chunk_bytes(big) - 1
+    batches = list(batch_documents([small, big, small], batch_size=100, max_bytes=max_bytes))
+    assert batches == [[small], [big], [small]]
+
+# --- CHUNKING ---
+def test_chunk_ids_are_unique_even_for_repeated_text():
+    docs = [doc("Newton's first law. " * 200), doc("Newton's first law. " * 200, source="NOTES: forces.mmd")]
+    chunks = list(chunk_documents(docs))
+    ids = [f"{c.metadata['source']}:{c.metadata['start_index']}" for c in chunks]
+    assert len(chunks) > 2
+    assert len(ids) == len(set(ids))
+
+# --- LOADING ---
+def test_load_documents_is_lazy(tmp_path):
+    syllabus, notes = tmp_path / "syllabus.mmd", tmp_path / "notes"
+    docs = load_documents(str(syllabus), str(notes))  # nothing exists yet, so this must not read anything
+
+    syllabus.write_text("Kinematics")
+    notes.mkdir()
+    (notes / "b.mmd").write_text("Momentum")
+    (notes / "a.mmd").write_text("Forces")
+    (notes / "scan.pdf").write_text("ignored")
+
+    assert [(d.metadata["source"], d.page_content) for d in docs] == [
+        ("SYLLABUS", "Kinematics"),
+        ("NOTES: a.mmd", "Forces"),
+        ("NOTES: b.mmd", "Momentum"),
+    ]
+
+# --- STORAGE ---
+def test_rebuild_upserts_by_id_and_drops_stale_chunks(tmp_path):
+    pytest.importorskip("chromadb")
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from rag_pipeline import EMBEDDING_DIM, INDEX_COMPLETE_MARKER, embed_and_store
+
+    embedder = DeterministicFakeEmbedding(size=EMBEDDING_DIM)
+    persist_dir = str(tmp_path / "chroma")
+    syllabus, notes = doc("Kinematics. " * 100), doc("Forces. " * 100, source="NOTES: forces.mmd")
+
+    vectordb = embed_and_store(chunk_documents([syllabus, notes]), persist_dir, batch_size=3, embedder=embedder)
+    first_ids = set(vectordb.get(include=[])["ids"])
+    assert (tmp_path / "chroma" / INDEX_COMPLETE_MARKER).exists()
+
+    # Same corpus again: overwritten in place, not duplicated
+    vectordb = embed_and_store(chunk_documents([syllabus, notes]), persist_dir, batch_size=3, embedder=embedder)
+    assert set(vectordb.get(include=[])["ids"]) == first_ids
+
+    # Shrunk notes: chunks past the new end are removed
+    shrunk = doc("Forces. " * 10, source="NOTES: forces.mmd")
+    vectordb = embed_and_store(chunk_documents([syllabus, shrunk]), persist_dir, batch_size=3, embedder=embedder)
+    ids = set(vectordb.get(include=[])["ids"])
+    assert ids == {f"{c.metadata['source']}:{c.metadata['start_index']}" for c in chunk_documents([syllabus, shrunk])}
+    assert ids < first_ids